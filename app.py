@@ -1,10 +1,31 @@
-from flask import Flask, Response
+from flask import Flask, Response, request, abort
+from werkzeug.wsgi import wrap_file
 import requests
 import re
 import os
 import itertools
+import functools
 import time 
 import json 
+import tempfile
+import io
+import hmac
+import signal
+import cProfile
+import pstats
+import threading
+import socket
+import queue
+import hashlib
+import gzip
+import zlib
+import math
+import random
+import traceback
+from array import array
+from xml.sax.saxutils import quoteattr
+import xml.etree.ElementTree as ET
+from collections import Counter, deque
 
 # Initialize the Flask web application
 app = Flask(__name__)
@@ -12,6 +33,12 @@ app = Flask(__name__)
 # Regex definitions 
 EXTINF_REGEX = re.compile(r'^(#EXTINF:[^,]*)(?:,)(.*)', re.IGNORECASE)
 TVG_URL_REGEX = re.compile(r'url-tvg="([^"]+)"', re.IGNORECASE)
+TVG_ID_BYTES_REGEX = re.compile(rb'tvg-id="([^"]+)"', re.IGNORECASE)
+# Byte-level equivalents used by the streaming parser
+EXTINF_BYTES_REGEX = re.compile(rb'^(#EXTINF:[^,]*)(?:,)(.*)', re.IGNORECASE)
+STREAM_PREFIXES = (b'http', b'rtmp')
+# Characters str.strip() removes from an ASCII line
+ASCII_WHITESPACE = b' \t\n\r\x0b\x0c\x1c\x1d\x1e\x1f'
 
 # ======== Categories (Final Exhaustive Keyword List for Stability) ========
 CATEGORIES = {
@@ -50,15 +77,130 @@ CATEGORIES = {
                     "investigation", "crime", "hgtv", "cooking channel", "food network", "weather"],
 }
 
-# --- Category Sets for Logic Flow ---
-US_CATEGORY_NAMES = {"USA News", "USA Movies", "USA Kids", "US LATINO", "Documentary", "Sports", "USA General"}
-MEXICO_CATEGORY_NAMES = {"Mexico News", "Mexico General", "Mexico Kids"}
-# --- End Category Sets ---
+# --- Category Priority for Logic Flow (checked in this order, first match wins) ---
+# Ordered tuples rather than sets, so a channel lands in the same group after every restart.
+US_CATEGORY_NAMES = ("USA News", "USA Movies", "USA Kids", "US LATINO", "Sports", "USA General")
+MEXICO_CATEGORY_NAMES = ("Mexico News", "Mexico General", "Mexico Kids")
+# --- End Category Priority ---
 
 # Acceptable prefixes for initial filtering
 ACCEPTABLE_PREFIXES = ('US|', 'MX|', 'MXC|')
 
 
+# ======== Compiled Keyword Matcher ========
+
+class CategoryMatcher:
+    """
+    Aho-Corasick automaton over the keywords of an ordered list of categories.
+
+    Categories are ranked in the order of `category_names`; a single pass over
+    the display name returns the highest-ranked category that has any keyword
+    in it, which is exactly what the old per-category `any()` scan did.
+    """
+
+    def __init__(self, category_names):
+        unknown = [name for name in category_names if not CATEGORIES.get(name)]
+        if unknown:
+            raise ValueError(f"Category priority lists categories with no keywords: {', '.join(unknown)}")
+        self.categories = list(category_names)
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [None]
+
+        # --- Build the keyword trie, each node remembering its best rank ---
+        for rank, name in enumerate(self.categories):
+            for keyword in CATEGORIES[name]:
+                state = 0
+                for ch in keyword:
+                    next_state = self.goto[state].get(ch)
+                    if next_state is None:
+                        next_state = len(self.goto)
+                        self.goto.append({})
+                        self.fail.append(0)
+                        self.output.append(None)
+                        self.goto[state][ch] = next_state
+                    state = next_state
+                if self.output[state] is None or rank < self.output[state]:
+                    self.output[state] = rank
+
+        # --- Breadth-first failure links; fold suffix outputs into each node ---
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and ch not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                target = self.goto[fallback].get(ch, 0)
+                self.fail[next_state] = target if target != next_state else 0
+                inherited = self.output[self.fail[next_state]]
+                if inherited is not None and (self.output[next_state] is None or inherited < self.output[next_state]):
+                    self.output[next_state] = inherited
+
+    def match(self, text):
+        """Returns the highest-priority category with a keyword in `text`, or None."""
+        goto, fail, output = self.goto, self.fail, self.output
+        state = 0
+        best = None
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            rank = output[state]
+            if rank is not None and (best is None or rank < best):
+                best = rank
+                if best == 0:
+                    break
+        return self.categories[best] if best is not None else None
+
+
+# Region -> (category priority, fallback category)
+REGION_CATEGORIES = {
+    "US": (US_CATEGORY_NAMES, "USA General"),
+    "MX": (MEXICO_CATEGORY_NAMES, "Mexico General"),
+}
+
+# ======== Category Decision Cache ========
+
+# Most recent (region, display name) decisions kept; backup feeds repeat names constantly
+CATEGORY_CACHE_SIZE = int(os.environ.get("CATEGORY_CACHE_SIZE", 65536))
+
+def categories_fingerprint():
+    """Changes whenever the keyword lists or priorities are edited at runtime."""
+    return hash(repr((CATEGORIES, REGION_CATEGORIES)))
+
+def compile_category_rules():
+    """Builds one automaton per region from the current CATEGORIES."""
+    return {region: CategoryMatcher(names) for region, (names, _) in REGION_CATEGORIES.items()}
+
+# Compiled once at startup, one automaton per region; recompiled if CATEGORIES changes
+CATEGORY_MATCHERS = compile_category_rules()
+category_rules_fingerprint = categories_fingerprint()
+
+@functools.lru_cache(maxsize=CATEGORY_CACHE_SIZE)
+def decide_category(region, display_lower):
+    """
+    Final group for a lower-cased display name in a region (keyword match or
+    the region fallback). Memoized; hit/miss counters via decide_category.cache_info().
+    """
+    return CATEGORY_MATCHERS[region].match(display_lower) or REGION_CATEGORIES[region][1]
+
+def ensure_category_rules():
+    """
+    Recompiles the matchers and drops memoized decisions if CATEGORIES changed
+    since they were built. Returns the fingerprint of the rules now in use.
+    """
+    global CATEGORY_MATCHERS, category_rules_fingerprint
+    fingerprint = categories_fingerprint()
+    if fingerprint != category_rules_fingerprint:
+        print("Category rules changed; recompiling matchers and clearing cached decisions.")
+        CATEGORY_MATCHERS = compile_category_rules()
+        decide_category.cache_clear()
+        category_rules_fingerprint = fingerprint
+    return fingerprint
+
+
 # ======== Helper Functions (No LLM) ========
 
 def add_group_title(extinf_line, category, display_name):
@@ -77,89 +219,1687 @@ def add_group_title(extinf_line, category, display_name):
     final_line = re.sub(r',.*$', f',{display_name}', modified_line)
     return final_line
 
-def stream_and_categorize(lines_iterator, tvg_url=None):
+def rewrite_extinf(extinf_line, category, display_name):
+    """
+    Single-pass version of add_group_title for a raw EXTINF line: locates the
+    group-title attribute once and rebuilds the line around it. Returns bytes.
+    Lines whose group-title sits outside the attribute section, has no quoted
+    value, or could be spelled with a Turkish dotted/dotless i (which the
+    Unicode-aware regex in add_group_title folds to "i") are handed to it unchanged.
+    """
+    if b'\xc4\xb0' in extinf_line or b'\xc4\xb1' in extinf_line:
+        return add_group_title(extinf_line.decode('utf-8'), category, display_name).encode('utf-8')
+
+    comma = extinf_line.find(b',')
+    # bytes.lower() only folds ASCII, matching the lower() check in add_group_title
+    key_start = extinf_line.lower().find(b'group-title')
+    tail = b',' + display_name.encode('utf-8')
+
+    if key_start < 0:
+        return extinf_line[:comma] + b' group-title="' + category.encode('utf-8') + b'"' + tail
+
+    value_start = key_start + 13
+    if extinf_line[key_start + 11:value_start] == b'="':
+        value_end = extinf_line.find(b'"', value_start) + 1
+        if 0 < value_end <= comma:
+            return (extinf_line[:key_start] + b'group-title="' + category.encode('utf-8') + b'"'
+                    + extinf_line[value_end:comma] + tail)
+
+    return add_group_title(extinf_line.decode('utf-8'), category, display_name).encode('utf-8')
+
+# ======== Stream De-Duplication ========
+
+# "hash" keeps exact 64-bit URL hashes; "bloom" caps memory at a configurable false-positive rate
+DEDUP_MODE = os.environ.get("DEDUP_MODE", "hash").lower()
+DEDUP_BLOOM_CAPACITY = int(os.environ.get("DEDUP_BLOOM_CAPACITY", 1000000))
+DEDUP_BLOOM_FALSE_POSITIVE_RATE = float(os.environ.get("DEDUP_BLOOM_FALSE_POSITIVE_RATE", 0.0001))
+
+HASH_MASK = 0xFFFFFFFFFFFFFFFF
+
+class StreamHashSet:
+    """
+    Open-addressing set of 64-bit stream URL hashes in a flat array, so each
+    request keeps 16-32 bytes per stream instead of the URL and a set slot.
+    """
+
+    def __init__(self, capacity=1 << 16):
+        self.table = array('Q', bytes(8 * capacity))
+        self.mask = capacity - 1
+        self.size = 0
+
+    def add(self, item):
+        """Adds `item`; returns False if it was already present."""
+        key = (hash(item) & HASH_MASK) or 1  # 0 marks an empty slot
+        table = self.table
+        mask = self.mask
+        slot = key & mask
+        while True:
+            current = table[slot]
+            if current == 0:
+                break
+            if current == key:
+                return False
+            slot = (slot + 1) & mask
+        table[slot] = key
+        self.size += 1
+        if self.size * 2 > mask:
+            self._grow()
+        return True
+
+    def _grow(self):
+        old_table = self.table
+        self.table = array('Q', bytes(16 * len(old_table)))
+        self.mask = len(self.table) - 1
+        for key in old_table:
+            if key:
+                slot = key & self.mask
+                while self.table[slot]:
+                    slot = (slot + 1) & self.mask
+                self.table[slot] = key
+
+    @property
+    def nbytes(self):
+        return self.table.itemsize * len(self.table)
+
+class StreamBloomFilter:
+    """
+    Fixed-size Bloom filter over stream URLs. Memory does not grow with the
+    playlist; a false positive drops a unique stream as if it were a duplicate.
+    """
+
+    def __init__(self, capacity, false_positive_rate):
+        self.bits = max(8, int(-capacity * math.log(false_positive_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, round(self.bits / capacity * math.log(2)))
+        self.bitmap = bytearray((self.bits + 7) // 8)
+
+    def add(self, item):
+        """Adds `item`; returns False if it was (probably) already present."""
+        key = hash(item) & HASH_MASK
+        first, step = key & 0xFFFFFFFF, (key >> 32) | 1
+        bitmap = self.bitmap
+        added = False
+        for i in range(self.hashes):
+            bit = (first + i * step) % self.bits
+            index, flag = bit >> 3, 1 << (bit & 7)
+            if not bitmap[index] & flag:
+                bitmap[index] |= flag
+                added = True
+        return added
+
+    @property
+    def nbytes(self):
+        return len(self.bitmap)
+
+def new_seen_streams():
+    """Creates the per-request de-duplication structure selected by DEDUP_MODE."""
+    if DEDUP_MODE == "bloom":
+        return StreamBloomFilter(DEDUP_BLOOM_CAPACITY, DEDUP_BLOOM_FALSE_POSITIVE_RATE)
+    return StreamHashSet()
+
+# ======== Incremental Re-Categorization ========
+
+class EntryCache:
+    """
+    Remembers the EXTINF line and category produced for every (EXTINF line, URL)
+    pair, keyed on a hash of the pair. A refresh only categorizes entries that are new or changed
+    upstream; entries that disappeared are dropped when the refresh commits.
+    """
+
+    MISS = object()
+
+    def __init__(self):
+        self.entries = {}
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+        self.rules_fingerprint = None
+
+    def begin(self, rules_fingerprint=None):
+        # Outputs built under other category rules are no longer valid
+        if rules_fingerprint != self.rules_fingerprint:
+            self.entries = {}
+            self.rules_fingerprint = rules_fingerprint
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Returns the cached (output line, category), None for a filtered entry, or MISS."""
+        value = self.entries.get(key, self.MISS)
+        if value is self.MISS:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.pending[key] = value
+        return value
+
+    def put(self, key, value):
+        self.pending[key] = value
+
+    def commit(self):
+        """Swaps in the entries seen by the completed run."""
+        self.entries = self.pending
+        self.pending = {}
+
+class PipelineStats:
+    """Entry counts of a stream_and_categorize run."""
+
+    def __init__(self):
+        self.processed = 0
+        self.filtered = 0
+        self.duplicates = 0
+        self.emitted = Counter()
+
+def stream_and_categorize(lines_iterator, tvg_url=None, entry_cache=None, stats=None):
     """
     Generator that processes the M3U line-by-line using stable keyword logic.
+    Works on the raw bytes: only the display name is decoded for categorization,
+    and URL lines are passed through untouched. Yields UTF-8 encoded bytes.
+    With an EntryCache, unchanged entries are emitted from it without being re-categorized.
+    Entry counts are added to `stats` (a PipelineStats) when the run ends.
     """
-    seen_streams = set()
+    seen_streams = new_seen_streams()
+    rules_fingerprint = ensure_category_rules()
+    if entry_cache is not None:
+        entry_cache.begin(rules_fingerprint)
     
     header = '#EXTM3U'
     if tvg_url:
         header += f' url-tvg="{tvg_url}"'
-    yield header + '\n'
+    yield (header + '\n').encode('utf-8')
 
     current_ext = None
+    processed = filtered = duplicates = 0
+    emitted = Counter()
     
-    for raw_line in lines_iterator:
+    try:
+        for raw_line in lines_iterator:
+            # Same result as raw_line.decode('utf-8').strip(), without decoding ASCII lines
+            if raw_line.isascii():
+                line = raw_line.strip(ASCII_WHITESPACE)
+            else:
+                try:
+                    line = raw_line.decode('utf-8').strip().encode('utf-8')
+                except UnicodeDecodeError:
+                    continue
+
+            if line.startswith(b'#EXTINF'):
+                current_ext = line
+                continue
+            
+            if current_ext and line.startswith(STREAM_PREFIXES):
+                processed += 1
+
+                # --- 0. Reuse the output of an unchanged entry ---
+                entry_key = None
+                if entry_cache is not None:
+                    entry_key = hash((current_ext, line))
+                    cached = entry_cache.get(entry_key)
+                    if cached is not EntryCache.MISS:
+                        current_ext = None
+                        if cached is None:
+                            filtered += 1
+                            continue
+                        if not seen_streams.add(line):
+                            duplicates += 1
+                            continue
+                        cached_ext_line, final_group = cached
+                        emitted[final_group] += 1
+                        yield cached_ext_line + b'\n' + line + b'\n'
+                        continue
+                
+                display_match = EXTINF_BYTES_REGEX.match(current_ext)
+                if not display_match:
+                    if entry_key is not None:
+                        entry_cache.put(entry_key, None)
+                    filtered += 1
+                    current_ext = None
+                    continue
+
+                display_name = display_match.group(2).decode('utf-8').strip()
+                display_lower = display_name.lower()
+                display_upper = display_name.upper()
+                
+                # --- 1. Prefix Filter & Region Determination ---
+                if display_upper.startswith('US|'):
+                    region = "US"
+                elif display_upper.startswith(('MX|', 'MXC|')):
+                    region = "MX"
+                else:
+                    if entry_key is not None:
+                        entry_cache.put(entry_key, None)
+                    filtered += 1
+                    current_ext = None 
+                    continue
+
+                # --- 2. De-Duplication Check ---
+                if not seen_streams.add(line):
+                    duplicates += 1
+                    current_ext = None 
+                    continue
+
+                # --- 3. & 4. Keyword Categorization (Priority Check) with Final Fallback ---
+                final_group = decide_category(region, display_lower)
+
+                # --- 5. Final Formatting and Prefix Removal ---
+                
+                new_display_name = display_name
+                for prefix in ACCEPTABLE_PREFIXES:
+                    if new_display_name.upper().startswith(prefix):
+                        new_display_name = new_display_name[len(prefix):].lstrip()
+                        break
+
+                modified_ext_line = rewrite_extinf(current_ext, final_group, new_display_name)
+                if entry_key is not None:
+                    entry_cache.put(entry_key, (modified_ext_line, final_group))
+                emitted[final_group] += 1
+                
+                yield modified_ext_line + b'\n' + line + b'\n'
+
+                current_ext = None
+
+            elif current_ext:
+                current_ext = None
+
+        if entry_cache is not None:
+            entry_cache.commit()
+    finally:
+        if stats is not None:
+            stats.processed += processed
+            stats.filtered += filtered
+            stats.duplicates += duplicates
+            stats.emitted.update(emitted)
+
+# ======== Metrics (Prometheus Text Format) ========
+
+# Buckets in seconds, from a quick header to a full five-minute download
+TIME_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+METRICS = []
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{escape_label(value)}"' for key, value in labels) + '}'
+
+class Metric:
+    """A named metric with optional labels, registered for /metrics."""
+
+    kind = None
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self.values = {}
+        self.lock = threading.Lock()
+        METRICS.append(self)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            for labels, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{format_labels(labels)} {value}")
+        return lines
+
+class CounterMetric(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class GaugeMetric(Metric):
+    kind = "gauge"
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[tuple(sorted(labels.items()))] = value
+
+class HistogramMetric(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, buckets=TIME_BUCKETS):
+        super().__init__(name, help_text)
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+
+    def observe(self, value):
+        with self.lock:
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+                    break
+            else:
+                self.counts[-1] += 1
+            self.total += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+            lines.append(f"{self.name}_sum {self.total}")
+            lines.append(f"{self.name}_count {cumulative}")
+        return lines
+
+def render_metrics():
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+UPSTREAM_CONNECT_SECONDS = HistogramMetric("m3u_upstream_connect_seconds", "Time from request to upstream response headers.")
+UPSTREAM_FIRST_BYTE_SECONDS = HistogramMetric("m3u_upstream_first_byte_seconds", "Time from request to the upstream #EXTM3U header line.")
+UPSTREAM_DOWNLOAD_SECONDS = HistogramMetric("m3u_upstream_download_seconds", "Total time of a refresh, from the first attempt to the end of the upstream body.")
+UPSTREAM_ATTEMPTS = CounterMetric("m3u_upstream_attempts_total", "Upstream fetch attempts by outcome.")
+UPSTREAM_RETRIES = CounterMetric("m3u_upstream_retries_total", "Upstream fetch attempts after the first one of a refresh.")
+UPSTREAM_HEDGES = CounterMetric("m3u_upstream_hedges_total", "Requests sent to another host because the first was over the latency budget.")
+UPSTREAM_CIRCUIT_OPEN = GaugeMetric("m3u_upstream_circuit_open", "1 while the circuit breaker of an upstream host is open or half-open.")
+UPSTREAM_SHORT_CIRCUITS = CounterMetric("m3u_upstream_short_circuits_total", "Attempts skipped because the host's circuit was open, by host.")
+UPSTREAM_STALLS = CounterMetric("m3u_upstream_stalls_total", "Upstream downloads aborted by the stall watchdog, by host and reason.")
+UPSTREAM_RESUMES = CounterMetric("m3u_upstream_resumes_total", "Interrupted upstream downloads picked up again, by how (range, refetch, error).")
+UPSTREAM_HOST_LATENCY = GaugeMetric("m3u_upstream_host_latency_seconds", "Moving average of the time to #EXTM3U, by upstream host.")
+CATEGORIZE_SECONDS = HistogramMetric("m3u_categorize_seconds", "Time spent parsing and categorizing, excluding waits on the upstream.")
+ENTRIES = CounterMetric("m3u_entries_total", "Playlist entries by outcome (processed, filtered, duplicate, emitted).")
+ENTRIES_EMITTED = CounterMetric("m3u_entries_emitted_total", "Emitted playlist entries per category.")
+OUTPUT_BYTES = CounterMetric("m3u_output_bytes_total", "Playlist bytes sent to clients, by content encoding.")
+ACTIVE_STREAMS = GaugeMetric("m3u_active_streams", "Client /m3u responses currently being served.")
+CATEGORY_CACHE_LOOKUPS = GaugeMetric("m3u_category_cache_lookups", "Memoized category decisions by result since the rules were last compiled.")
+PLAYLIST_BYTES = GaugeMetric("m3u_playlist_bytes", "Size of the cached categorized playlist.")
+PLAYLIST_AGE_SECONDS = GaugeMetric("m3u_playlist_age_seconds", "Seconds since the cached playlist was last confirmed current.")
+
+def record_pipeline_stats(stats):
+    ENTRIES.inc(stats.processed, outcome="processed")
+    ENTRIES.inc(stats.filtered, outcome="filtered")
+    ENTRIES.inc(stats.duplicates, outcome="duplicate")
+    ENTRIES.inc(sum(stats.emitted.values()), outcome="emitted")
+    for category, count in stats.emitted.items():
+        ENTRIES_EMITTED.inc(count, category=category)
+
+def timed_lines(lines_iterator, waits):
+    """Passes lines through, adding the time spent waiting on the upstream to waits[0]."""
+    iterator = iter(lines_iterator)
+    while True:
+        started = time.perf_counter()
         try:
-            line = raw_line.decode('utf-8').strip()
-        except UnicodeDecodeError:
-            continue
+            raw_line = next(iterator)
+        except StopIteration:
+            waits[0] += time.perf_counter() - started
+            return
+        waits[0] += time.perf_counter() - started
+        yield raw_line
+
+# ======== Upstream HTTP Session ========
+
+# Connection pool and timeouts shared by every upstream request (playlist and EPG)
+UPSTREAM_POOL_SIZE = int(os.environ.get("UPSTREAM_POOL_SIZE", 10))
+UPSTREAM_CONNECT_TIMEOUT = float(os.environ.get("UPSTREAM_CONNECT_TIMEOUT", 10))
+UPSTREAM_READ_TIMEOUT = float(os.environ.get("UPSTREAM_READ_TIMEOUT", 300))
+UPSTREAM_TIMEOUT = (UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_READ_TIMEOUT)
+
+def create_upstream_session():
+    """Builds the keep-alive session; retries stay in our own loop, not in urllib3."""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=UPSTREAM_POOL_SIZE, pool_maxsize=UPSTREAM_POOL_SIZE, max_retries=0)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    # The playlist is multi-megabyte text; let the provider compress it
+    session.headers["Accept-Encoding"] = "gzip, deflate"
+    return session
+
+upstream_session = create_upstream_session()
+
+# ======== Upstream Fetch ========
+
+# Provider mirrors serving the same playlist, in order of preference
+UPSTREAM_HOSTS = [host.strip().rstrip("/") for host in os.environ.get("UPSTREAM_HOSTS", "http://line.premiumpowers.net").split(",") if host.strip()]
+# Seconds to wait for #EXTM3U from one host before also asking the next
+HEDGE_DELAY = float(os.environ.get("HEDGE_DELAY", 5))
+# Weight of the newest sample in the per-host latency average
+HOST_LATENCY_ALPHA = float(os.environ.get("HOST_LATENCY_ALPHA", 0.3))
+
+class HostLatency:
+    """
+    Exponentially weighted moving average of each host's time to #EXTM3U.
+    A failed attempt counts as at least UPSTREAM_CONNECT_TIMEOUT, so broken
+    hosts drift to the back of the order.
+    """
+
+    def __init__(self, alpha):
+        self.alpha = alpha
+        self.averages = {}
+        self.lock = threading.Lock()
+
+    def record(self, host, seconds, failed=False):
+        if failed:
+            seconds = max(seconds, UPSTREAM_CONNECT_TIMEOUT)
+        with self.lock:
+            previous = self.averages.get(host)
+            average = seconds if previous is None else previous + self.alpha * (seconds - previous)
+            self.averages[host] = average
+        UPSTREAM_HOST_LATENCY.set(round(average, 3), host=host)
+
+    def order(self, hosts):
+        """Fastest first; hosts never tried keep their configured place at the front."""
+        with self.lock:
+            return sorted(hosts, key=lambda host: self.averages.get(host, 0.0))
+
+host_latency = HostLatency(HOST_LATENCY_ALPHA)
+
+# Backoff between retry rounds of one refresh
+RETRY_BASE_DELAY = float(os.environ.get("RETRY_BASE_DELAY", 2))
+RETRY_MAX_DELAY = float(os.environ.get("RETRY_MAX_DELAY", 60))
+# Consecutive failures that open a host's circuit, and how long it stays open
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get("BREAKER_FAILURE_THRESHOLD", 3))
+BREAKER_BASE_DELAY = float(os.environ.get("BREAKER_BASE_DELAY", 30))
+BREAKER_MAX_DELAY = float(os.environ.get("BREAKER_MAX_DELAY", 900))
+
+def backoff_delay(exponent, base, cap):
+    """Exponential backoff with equal jitter: half of min(cap, base * 2**exponent) plus a random half."""
+    delay = min(cap, base * 2 ** exponent)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+class CircuitBreaker:
+    """
+    Shared per-host breaker. After BREAKER_FAILURE_THRESHOLD consecutive failures
+    the circuit opens and the host is skipped for a backoff period that doubles
+    with every trip. Then one probe is let through (half-open): success closes
+    the circuit, failure opens it again.
+    """
+
+    def __init__(self, host):
+        self.host = host
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.trips = 0
+        self.open_until = 0.0
+        self.successes = 0
+        self.failures = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """Whether an attempt may be sent now; claims the probe when half-open."""
+        with self.lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.time() >= self.open_until:
+                self.state = "half_open"
+                print(f"Circuit for {self.host} is half-open, sending a probe.")
+                return True
+            self.rejected += 1
+        UPSTREAM_SHORT_CIRCUITS.inc(host=self.host)
+        return False
+
+    def record(self, success):
+        with self.lock:
+            if success:
+                self.successes += 1
+                self.consecutive_failures = 0
+                if self.state != "closed":
+                    print(f"Circuit for {self.host} closed again.")
+                self.state = "closed"
+                self.trips = 0
+            else:
+                self.failures += 1
+                self.consecutive_failures += 1
+                if self.state == "half_open" or (self.state == "closed" and self.consecutive_failures >= BREAKER_FAILURE_THRESHOLD):
+                    open_for = backoff_delay(self.trips, BREAKER_BASE_DELAY, BREAKER_MAX_DELAY)
+                    self.trips += 1
+                    self.state = "open"
+                    self.open_until = time.time() + open_for
+                    print(f"Circuit for {self.host} opened for {open_for:.0f}s after {self.consecutive_failures} consecutive failures.")
+            UPSTREAM_CIRCUIT_OPEN.set(0 if self.state == "closed" else 1, host=self.host)
+
+    def status(self):
+        with self.lock:
+            return {
+                "host": self.host,
+                "state": self.state,
+                "consecutive_failures": self.consecutive_failures,
+                "trips": self.trips,
+                "retry_in": round(max(0.0, self.open_until - time.time()), 1) if self.state == "open" else 0.0,
+                "successes": self.successes,
+                "failures": self.failures,
+                "rejected": self.rejected,
+            }
+
+circuit_breakers = {host: CircuitBreaker(host) for host in UPSTREAM_HOSTS}
+
+# The upstream body is aborted when no line arrives for STALL_IDLE_TIMEOUT seconds,
+# or when less than STALL_MIN_THROUGHPUT bytes/s arrive over a STALL_WINDOW
+STALL_IDLE_TIMEOUT = float(os.environ.get("STALL_IDLE_TIMEOUT", 30))
+STALL_MIN_THROUGHPUT = float(os.environ.get("STALL_MIN_THROUGHPUT", 8192))
+STALL_WINDOW = float(os.environ.get("STALL_WINDOW", 30))
+STALL_CHECK_INTERVAL = float(os.environ.get("STALL_CHECK_INTERVAL", 1))
+
+class UpstreamStalled(requests.exceptions.RequestException):
+    """The stall watchdog aborted an upstream download."""
+
+def response_socket(response):
+    """
+    The socket under a streamed requests response. urllib3 drops it from the
+    connection once http.client knows the server will close, but the body's
+    socket file still holds it.
+    """
+    sock = getattr(response.raw.connection, "sock", None)
+    if sock is None:
+        body_file = getattr(getattr(response.raw, "_fp", None), "fp", None)
+        sock = getattr(getattr(body_file, "raw", None), "_sock", None)
+    return sock
+
+class WatchedDownload:
+    """Progress of one upstream body, as seen by the stall watchdog."""
+
+    def __init__(self, host, response):
+        self.host = host
+        self.response = response
+        self.last_progress = time.monotonic()
+        self.window_started = self.last_progress
+        self.window_bytes = 0
+        self.stalled = None
+
+    def progress(self, nbytes):
+        self.last_progress = time.monotonic()
+        self.window_bytes += nbytes
+
+    def check(self, now):
+        """Returns why the download counts as stalled, or None."""
+        if now - self.last_progress >= STALL_IDLE_TIMEOUT:
+            return "idle"
+        elapsed = now - self.window_started
+        if elapsed >= STALL_WINDOW:
+            if self.window_bytes / elapsed < STALL_MIN_THROUGHPUT:
+                return "throughput"
+            self.window_started = now
+            self.window_bytes = 0
+        return None
+
+    def abort(self, reason):
+        """Shuts the socket down, which wakes the reader blocked on it."""
+        self.stalled = reason
+        sock = response_socket(self.response)
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+class StallWatchdog:
+    """
+    One background thread checking every active upstream download each
+    STALL_CHECK_INTERVAL. A blocking read can only give up after the whole
+    UPSTREAM_READ_TIMEOUT, and a trickling upstream never trips it at all.
+    """
+
+    def __init__(self):
+        self.downloads = set()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def watch(self, host, response, lines_iterator):
+        """Wraps the lines of an upstream body so the watchdog can see them arrive."""
+        download = WatchedDownload(host, response)
+        with self.lock:
+            self.downloads.add(download)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+        try:
+            for raw_line in lines_iterator:
+                download.progress(len(raw_line) + 1)
+                yield raw_line
+        except (requests.exceptions.RequestException, OSError):
+            if download.stalled is None:
+                raise
+        finally:
+            with self.lock:
+                self.downloads.discard(download)
+        if download.stalled is not None:
+            # The shut-down socket can look like a clean end of a close-delimited body
+            response.close()
+            raise UpstreamStalled(f"Host {host} stalled ({download.stalled}), download aborted.")
+
+    def _run(self):
+        while True:
+            time.sleep(STALL_CHECK_INTERVAL)
+            now = time.monotonic()
+            with self.lock:
+                stalled = [(download, reason) for download in self.downloads if download.stalled is None
+                           for reason in (download.check(now),) if reason is not None]
+            for download, reason in stalled:
+                print(f"Stall watchdog: aborting download from {download.host} ({reason}).")
+                UPSTREAM_STALLS.inc(host=download.host, reason=reason)
+                # Push the host back in the failover order and towards an open circuit
+                host_latency.record(download.host, UPSTREAM_READ_TIMEOUT, failed=True)
+                circuit_breakers[download.host].record(False)
+                download.abort(reason)
+
+stall_watchdog = StallWatchdog()
+
+# How many times one interrupted download is picked up again before giving up
+RESUME_ATTEMPTS = int(os.environ.get("RESUME_ATTEMPTS", 3))
+UPSTREAM_CHUNK_SIZE = int(os.environ.get("UPSTREAM_CHUNK_SIZE", 65536))
+
+def body_lines(response, position):
+    """
+    Splits a streamed body into lines the way iter_lines() does, adding the
+    size of every line handed out (terminator included) to position[0]. That
+    is the byte offset a resumed download has to continue from.
+    """
+    pending = b''
+    for chunk in response.iter_content(chunk_size=UPSTREAM_CHUNK_SIZE):
+        pieces = (pending + chunk).splitlines(keepends=True)
+        pending = b''
+        # A trailing \r may be the first half of a \r\n split across chunks
+        if pieces and not pieces[-1].endswith(b'\n'):
+            pending = pieces.pop()
+        for piece in pieces:
+            position[0] += len(piece)
+            yield piece.rstrip(b'\r\n')
+    if pending:
+        position[0] += len(pending)
+        yield pending.rstrip(b'\r')
+
+def resume_download(m3u_url, response, offset):
+    """
+    Requests the rest of an interrupted body. With a validator, an uncompressed
+    body and byte-range support, only the missing bytes are asked for (If-Range
+    makes a changed playlist come back whole). Otherwise the whole playlist is
+    fetched again; the de-dup state of the running categorization then skips the
+    entries that were already emitted. Returns (response, starts_at_offset).
+    """
+    validator = response.headers.get("ETag") or response.headers.get("Last-Modified")
+    if validator and validator.startswith("W/"):
+        # If-Range needs a strong validator
+        validator = response.headers.get("Last-Modified")
+    can_range = (validator and response.headers.get("Accept-Ranges", "").lower() == "bytes"
+                 and response.headers.get("Content-Encoding", "identity") == "identity")
+    headers = {}
+    if can_range:
+        headers = {"Range": f"bytes={offset}-", "If-Range": validator, "Accept-Encoding": "identity"}
+    r = upstream_session.get(m3u_url, headers=headers, timeout=UPSTREAM_TIMEOUT, stream=True)
+    r.raise_for_status()
+    if r.status_code == 206 and r.headers.get("Content-Range", "").startswith(f"bytes {offset}-"):
+        UPSTREAM_RESUMES.inc(outcome="range")
+        return r, True
+    if r.status_code == 206:
+        r.close()
+        raise requests.exceptions.RequestException(f"Unexpected Content-Range {r.headers.get('Content-Range')!r} on resume.")
+    UPSTREAM_RESUMES.inc(outcome="refetch")
+    return r, False
+
+def resumable_lines(host, m3u_url, response, lines_iterator, position):
+    """
+    The lines of an upstream body, picking the download up again when the
+    connection drops or the stall watchdog aborts it, instead of ending in a
+    silently truncated playlist. Only whole lines are handed out, so a resumed
+    body continues exactly at the start of the line that was cut.
+    """
+    resumes = 0
+    while True:
+        try:
+            for raw_line in stall_watchdog.watch(host, response, lines_iterator):
+                yield raw_line
+            return
+        except requests.exceptions.RequestException as e:
+            error = e
+        response.close()
+
+        while True:
+            if resumes >= RESUME_ATTEMPTS:
+                raise error
+            time.sleep(backoff_delay(resumes, RETRY_BASE_DELAY, RETRY_MAX_DELAY))
+            resumes += 1
+            print(f"Upstream {host} was interrupted after {position[0]} bytes ({error}); resuming (attempt {resumes}/{RESUME_ATTEMPTS}).")
+            try:
+                response, continues = resume_download(m3u_url, response, position[0])
+                break
+            except requests.exceptions.RequestException as e:
+                UPSTREAM_RESUMES.inc(outcome="error")
+                error = e
+        if not continues:
+            position[0] = 0
+        lines_iterator = body_lines(response, position)
+
+class HostAttempt:
+    """The outcome of asking one host for the playlist, up to its #EXTM3U line."""
+
+    def __init__(self, host, response=None, lines_iterator=None, tvg_url=None, error=None):
+        self.host = host
+        self.response = response
+        self.lines_iterator = lines_iterator
+        self.tvg_url = tvg_url
+        self.error = error
+
+    def discard(self):
+        """Hands the connection of a losing attempt back."""
+        if self.response is not None:
+            self.response.close()
+
+def attempt_host(host, conditional_headers):
+    """Requests the playlist from one host and reads up to its first line."""
+    username = os.environ.get("USERNAME")
+    password = os.environ.get("PASSWORD")
+
+    # --- CRITICAL CHANGE: output=hls for improved streaming stability ---
+    m3u_url = f"{host}/get.php?username={username}&password={password}&type=m3u_plus&output=hls"
+    attempt_started = time.perf_counter()
+    r = None
+
+    try:
+        r = upstream_session.get(m3u_url, headers=conditional_headers, timeout=UPSTREAM_TIMEOUT, stream=True) 
+        UPSTREAM_CONNECT_SECONDS.observe(time.perf_counter() - attempt_started)
+        r.raise_for_status() 
+
+        if r.status_code == 304:
+            print(f"Host {host} reports the playlist is unchanged (304).")
+            UPSTREAM_ATTEMPTS.inc(outcome="not_modified")
+            host_latency.record(host, time.perf_counter() - attempt_started)
+            circuit_breakers[host].record(True)
+            return HostAttempt(host, r)
+        
+        position = [0]
+        raw_lines_iterator = body_lines(r, position)
+        first_line_raw = next(raw_lines_iterator, b'')
+        # An HTML error page need not be UTF-8; it only has to fail the #EXTM3U check
+        first_line = first_line_raw.decode('utf-8', 'replace').strip()
+        elapsed = time.perf_counter() - attempt_started
+        UPSTREAM_FIRST_BYTE_SECONDS.observe(elapsed)
+        
+        if first_line.startswith('#EXTM3U'):
+            tvg_url = None
+            tvg_match = TVG_URL_REGEX.search(first_line)
+            if tvg_match:
+                tvg_url = tvg_match.group(1)
 
-        if line.startswith('#EXTINF'):
-            current_ext = line
+            UPSTREAM_ATTEMPTS.inc(outcome="ok")
+            host_latency.record(host, elapsed)
+            circuit_breakers[host].record(True)
+            lines_iterator = resumable_lines(host, m3u_url, r, raw_lines_iterator, position)
+            return HostAttempt(host, r, itertools.chain([first_line_raw], lines_iterator), tvg_url)
+        else:
+            error = f"Host {host} returned content that didn't start with #EXTM3U."
+            print(error)
+            UPSTREAM_ATTEMPTS.inc(outcome="invalid")
+            host_latency.record(host, elapsed, failed=True)
+            circuit_breakers[host].record(False)
+            # Hand the connection back to the pool for the next attempt
+            r.close()
+            return HostAttempt(host, error=error)
+
+    except Exception as e:
+        # Runs on a race thread: every failure has to come back as an outcome
+        error = f"Host {host} failed with error: {e}"
+        print(error)
+        UPSTREAM_ATTEMPTS.inc(outcome="error")
+        host_latency.record(host, time.perf_counter() - attempt_started, failed=True)
+        circuit_breakers[host].record(False)
+        if r is not None:
+            r.close()
+        return HostAttempt(host, error=error)
+
+class HostRace:
+    """
+    Collects the attempts of one hedged fetch. Once a winner is picked, attempts
+    that report afterwards are discarded instead of queued.
+    """
+
+    def __init__(self):
+        self.outcomes = queue.Queue()
+        self.decided = False
+        self.lock = threading.Lock()
+
+    def launch(self, host, conditional_headers):
+        threading.Thread(target=self._attempt, args=(host, conditional_headers), daemon=True).start()
+
+    def _attempt(self, host, conditional_headers):
+        """Runs one attempt; whatever happens, race_hosts hears back from it."""
+        outcome = HostAttempt(host, error=f"Host {host} attempt failed unexpectedly.")
+        try:
+            outcome = attempt_host(host, conditional_headers)
+        finally:
+            self.report(outcome)
+
+    def report(self, outcome):
+        with self.lock:
+            if not self.decided:
+                self.outcomes.put(outcome)
+                return
+        outcome.discard()
+
+    def decide(self):
+        with self.lock:
+            self.decided = True
+        while True:
+            try:
+                self.outcomes.get_nowait().discard()
+            except queue.Empty:
+                return
+
+def race_hosts(hosts, conditional_headers):
+    """
+    Asks the hosts whose circuit allows it in order, hedging to the next one
+    whenever none has produced #EXTM3U within HEDGE_DELAY (or as soon as one
+    fails). The first valid answer wins. Returns (winning HostAttempt or None,
+    last_error); last_error is None too when every circuit was open.
+    """
+    pending = list(hosts)
+    race = HostRace()
+    running = 0
+    last_error = None
+
+    def launch_next():
+        while pending:
+            host = pending.pop(0)
+            if circuit_breakers[host].allow():
+                print(f"Attempting connection to: {host}")
+                race.launch(host, conditional_headers)
+                return True
+        return False
+
+    if launch_next():
+        running += 1
+    while running:
+        try:
+            outcome = race.outcomes.get(timeout=HEDGE_DELAY if pending else None)
+        except queue.Empty:
+            print(f"No #EXTM3U within {HEDGE_DELAY}s, hedging.")
+            if launch_next():
+                UPSTREAM_HEDGES.inc()
+                running += 1
             continue
+        running -= 1
+        if outcome.error is None:
+            race.decide()
+            return outcome, None
+        last_error = outcome.error
+        if launch_next():
+            running += 1
+    race.decide()
+    return None, last_error
+
+def fetch_source_m3u(conditional_headers=None):
+    """
+    Connects to the provider mirrors using a retry mechanism and extracts the EPG URL.
+    Returns (response, lines_iterator, tvg_url, last_error). lines_iterator is None
+    on failure, or when the provider answers 304 to the conditional headers.
+    Fails fast, without waiting out the retries, while every host's circuit is open.
+    """
+    last_error = "Initial attempt failed."
+    
+    # Robust Retry Loop (up to 5 rounds across every host)
+    for attempt in range(5):
+        print(f"Fetching playlist (Attempt {attempt + 1}/5)")
+        if attempt:
+            UPSTREAM_RETRIES.inc()
+
+        winner, error = race_hosts(host_latency.order(UPSTREAM_HOSTS), conditional_headers)
+        if winner is not None:
+            return winner.response, winner.lines_iterator, winner.tvg_url, None
+        if error is None:
+            print("FATAL: Every upstream circuit is open, not retrying.")
+            error = "Every upstream host is failing (circuits open)."
+            if attempt:
+                error += f" Last error was: {last_error}"
+            return None, None, None, error
+        last_error = error
         
-        if current_ext and (line.startswith('http') or line.startswith('rtmp')):
-            
-            display_match = EXTINF_REGEX.match(current_ext)
-            if not display_match:
-                current_ext = None
-                continue
+        if attempt < 4:
+            time.sleep(backoff_delay(attempt, RETRY_BASE_DELAY, RETRY_MAX_DELAY))
 
-            display_name = display_match.group(2).strip()
-            display_lower = display_name.lower()
-            display_upper = display_name.upper()
-            
-            # --- 1. Prefix Filter & Region Determination ---
-            if display_upper.startswith('US|'):
-                target_categories = US_CATEGORY_NAMES
-                fallback_category = "USA General"
-            elif display_upper.startswith(('MX|', 'MXC|')):
-                target_categories = MEXICO_CATEGORY_NAMES
-                fallback_category = "Mexico General"
+    print("FATAL: All attempts failed to return a valid M3U file.")
+    return None, None, None, last_error
+
+# ======== Playlist Cache (Stale-While-Revalidate) ========
+
+# Seconds between background refreshes of the categorized playlist
+REFRESH_INTERVAL = int(os.environ.get("REFRESH_INTERVAL", 3600))
+
+# Where the last good playlist is persisted for cold starts and served from (empty disables it)
+# The temp-dir default only survives gunicorn worker restarts: a dyno restart or deploy
+# starts from an empty filesystem, so to cover those SNAPSHOT_DIR must point at persistent
+# storage (e.g. a mounted volume).
+SNAPSHOT_DIR = os.environ.get("SNAPSHOT_DIR", os.path.join(tempfile.gettempdir(), "iptvcategorizer"))
+SNAPSHOT_FORMAT = 2
+VARIANT_SUFFIXES = {"identity": ".m3u", "gzip": ".m3u.gz", "br": ".m3u.br"}
+
+def hash_lines(lines_iterator, digest):
+    """Feeds every raw line into `digest` as it passes through."""
+    for raw_line in lines_iterator:
+        digest.update(raw_line + b'\n')
+        yield raw_line
+
+# The upstream body is buffered in memory up to this many bytes, then in a temp file
+SPOOL_MEMORY_LIMIT = int(os.environ.get("SPOOL_MEMORY_LIMIT", 8 * 1024 * 1024))
+SPOOL_BLOCK_SIZE = 65536
+
+class Spool:
+    """
+    Downloads an upstream body at full speed on its own thread, so the provider
+    connection is released as soon as the body is in, however long categorizing
+    it (and the clients attached to that) takes. The lines are kept in a
+    SpooledTemporaryFile; any number of readers follow it from the start.
+    """
+
+    def __init__(self, lines_iterator):
+        self.file = tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY_LIMIT)
+        self.size = 0
+        self.done = False
+        self.closed = False
+        self.error = None
+        self.finished_at = None
+        self.condition = threading.Condition()
+        threading.Thread(target=self._fill, args=(lines_iterator,), daemon=True).start()
+
+    def _fill(self, lines_iterator):
+        error = None
+        block = []
+        block_size = 0
+        try:
+            for raw_line in lines_iterator:
+                block.append(raw_line)
+                block_size += len(raw_line) + 1
+                if block_size >= SPOOL_BLOCK_SIZE:
+                    if not self._append(block):
+                        return
+                    block = []
+                    block_size = 0
+            if block:
+                self._append(block)
+        except Exception as e:
+            # Handed to the readers, so a failed download never looks like a short one
+            error = e
+        finally:
+            with self.condition:
+                self.done = True
+                self.error = error
+                self.finished_at = time.perf_counter()
+                self.condition.notify_all()
+
+    def _append(self, block):
+        """Appends whole lines; returns False once the spool has been closed."""
+        data = b'\n'.join(block) + b'\n'
+        with self.condition:
+            if self.closed:
+                return False
+            self.file.seek(0, 2)
+            self.file.write(data)
+            self.size += len(data)
+            self.condition.notify_all()
+        return True
+
+    def lines(self):
+        """The spooled lines from the beginning, waiting for the download where it is behind."""
+        offset = 0
+        pending = b''
+        while True:
+            with self.condition:
+                while offset == self.size and not self.done:
+                    self.condition.wait()
+                if offset == self.size or self.closed:
+                    error = self.error
+                    break
+                self.file.seek(offset)
+                data = self.file.read(min(self.size - offset, SPOOL_BLOCK_SIZE * 16))
+            offset += len(data)
+            lines = (pending + data).split(b'\n')
+            pending = lines.pop()
+            yield from lines
+        if error is not None:
+            raise error
+
+    def close(self):
+        """Drops the spooled body; a download still running stops at its next block."""
+        with self.condition:
+            self.closed = True
+            self.file.close()
+            self.condition.notify_all()
+
+# Categorized output is handed to clients in chunks of this size...
+OUTPUT_CHUNK_SIZE = int(os.environ.get("OUTPUT_CHUNK_SIZE", 65536))
+# ...or whatever is buffered once no chunk has gone out for this many seconds
+OUTPUT_FLUSH_INTERVAL = float(os.environ.get("OUTPUT_FLUSH_INTERVAL", 0.25))
+
+class RefreshFailed(Exception):
+    """The shared fetch failed after clients had started receiving its output."""
+
+class Flight:
+    """
+    A single in-flight upstream fetch. Categorized entries are buffered into
+    OUTPUT_CHUNK_SIZE chunks as they are produced and every attached client
+    streams the chunks from its own position.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.buffer = []
+        self.buffered = 0
+        self.done = False
+        self.error = None
+        self.condition = threading.Condition()
+
+    def publish(self, piece):
+        with self.condition:
+            self.buffer.append(piece)
+            self.buffered += len(piece)
+            # The first piece (the #EXTM3U header) goes out at once to keep time-to-first-byte low
+            if self.buffered >= OUTPUT_CHUNK_SIZE or not self.chunks:
+                self._flush()
+
+    def _flush(self):
+        """Seals the buffered pieces into one chunk. Caller holds the condition."""
+        if self.buffer:
+            self.chunks.append(b''.join(self.buffer))
+            self.buffer = []
+            self.buffered = 0
+            self.condition.notify_all()
+
+    def collect(self):
+        """Flushes the buffer and returns the whole output produced so far."""
+        with self.condition:
+            self._flush()
+            return b''.join(self.chunks)
+
+    def finish(self, error=None):
+        with self.condition:
+            self._flush()
+            self.error = error
+            self.done = True
+            self.condition.notify_all()
+
+    def wait_started(self):
+        """Blocks until the first chunk is produced; returns the error if the fetch ended without one."""
+        with self.condition:
+            self.condition.wait_for(lambda: self.chunks or self.done)
+            if self.chunks:
+                return None
+            return self.error or "The refresh ended without producing a playlist."
+
+    def stream(self):
+        """
+        Yields every chunk produced so far, then follows the fetch until it finishes.
+        Raises RefreshFailed if the fetch failed, so the server aborts the response
+        and the client sees an incomplete transfer instead of a short, valid playlist.
+        """
+        position = 0
+        while True:
+            with self.condition:
+                while position >= len(self.chunks) and not self.done:
+                    if not self.condition.wait(OUTPUT_FLUSH_INTERVAL):
+                        # Producer has gone quiet: ship what is buffered instead of holding it
+                        self._flush()
+                pending = self.chunks[position:]
+                finished = self.done
+            position += len(pending)
+            yield from pending
+            if finished:
+                if self.error is not None:
+                    raise RefreshFailed(self.error)
+                return
+
+# ======== Response Compression ========
+
+try:
+    import brotli
+except ImportError:  # Optional: without it only gzip variants are served
+    brotli = None
+
+GZIP_LEVEL = int(os.environ.get("GZIP_LEVEL", 6))
+BROTLI_QUALITY = int(os.environ.get("BROTLI_QUALITY", 5))
+# Server preference when the client accepts several encodings equally
+SUPPORTED_ENCODINGS = ("br", "gzip", "identity") if brotli is not None else ("gzip", "identity")
+
+def compress_variants(body):
+    """Builds every encoded variant of a snapshot body once, up front."""
+    variants = {"identity": body, "gzip": gzip.compress(body, GZIP_LEVEL, mtime=0)}
+    if brotli is not None:
+        variants["br"] = brotli.compress(body, quality=BROTLI_QUALITY)
+    return variants
+
+def compress_stream(chunks, encoding):
+    """Compresses a live stream chunk by chunk, flushing each one so clients are not held back."""
+    if encoding == "gzip":
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+        for chunk in chunks:
+            yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
+    elif encoding == "br":
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        for chunk in chunks:
+            yield compressor.process(chunk) + compressor.flush()
+        yield compressor.finish()
+    else:
+        yield from chunks
+
+def negotiate_encoding():
+    return request.accept_encodings.best_match(SUPPORTED_ENCODINGS, default="identity")
+
+class Snapshot:
+    """
+    One categorized playlist in every encoding it is served in, with the
+    validators it is served under and those of the upstream response it was built from.
+    """
+
+    def __init__(self, body, modified_at, upstream_etag=None, upstream_last_modified=None, source_hash=None, tvg_url=None, variants=None):
+        self.body = body
+        self.variants = variants if variants is not None else compress_variants(body)
+        self.etag = hashlib.sha256(body).hexdigest()[:32]
+        self.modified_at = modified_at
+        self.upstream_etag = upstream_etag
+        self.upstream_last_modified = upstream_last_modified
+        self.source_hash = source_hash
+        self.tvg_url = tvg_url
+        # encoding -> on-disk copy of the variant, once persisted
+        self.files = {}
+
+def write_atomically(path, data):
+    """Writes `data` to a temporary file next to `path`, fsyncs it and renames it into place."""
+    fd, temp_path = tempfile.mkstemp(prefix=".tmp-", dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+class PlaylistCache:
+    """
+    Keeps the last good categorized playlist in memory. Clients are answered
+    from it immediately while a background worker refreshes it on an interval.
+    Concurrent refreshes are coalesced into a single upstream fetch.
+    The last good playlist is also persisted under `directory`, so a restart
+    can serve it straight away and clients can be sent the files directly.
+    """
+
+    def __init__(self, interval, directory=None):
+        self.interval = interval
+        self.directory = directory
+        # Written into the playlist header in place of the provider's guide URL
+        self.epg_url = None
+        self.snapshot = None
+        self.updated_at = 0.0
+        self.flight = None
+        self.worker = None
+        self.entry_cache = EntryCache()
+        self.lock = threading.Lock()
+
+    def is_stale(self):
+        return time.time() - self.updated_at >= self.interval
+
+    def store(self, body, upstream_etag=None, upstream_last_modified=None, source_hash=None, tvg_url=None):
+        now = time.time()
+        snapshot = Snapshot(body, now, upstream_etag, upstream_last_modified, source_hash, tvg_url)
+        with self.lock:
+            # Last-Modified only moves when the categorized output actually changes
+            if self.snapshot is not None and self.snapshot.etag == snapshot.etag:
+                snapshot.modified_at = self.snapshot.modified_at
+            self.snapshot = snapshot
+            self.updated_at = now
+        self.save(snapshot, now)
+
+    def save(self, snapshot, saved_at):
+        """
+        Writes every variant of the snapshot to its own content-addressed file,
+        then atomically replaces snapshot.json, which names them and carries the
+        metadata. A crash at any point leaves the previous snapshot intact.
+        """
+        if not self.directory:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            files = {}
+            for encoding, data in snapshot.variants.items():
+                name = f"playlist-{snapshot.etag}{VARIANT_SUFFIXES[encoding]}"
+                path = os.path.join(self.directory, name)
+                if not os.path.exists(path):
+                    write_atomically(path, data)
+                files[encoding] = name
+            metadata = {
+                "format": SNAPSHOT_FORMAT,
+                "saved_at": saved_at,
+                "modified_at": snapshot.modified_at,
+                "etag": snapshot.etag,
+                "upstream_etag": snapshot.upstream_etag,
+                "upstream_last_modified": snapshot.upstream_last_modified,
+                "source_hash": snapshot.source_hash,
+                "tvg_url": snapshot.tvg_url,
+                "files": files,
+            }
+            write_atomically(os.path.join(self.directory, "snapshot.json"), json.dumps(metadata).encode('utf-8'))
+        except OSError as e:
+            print(f"Could not persist playlist snapshot to {self.directory}: {e}")
+            return
+        snapshot.files = {encoding: os.path.join(self.directory, name) for encoding, name in files.items()}
+        self.remove_stale_files(set(files.values()))
+
+    def remove_stale_files(self, keep):
+        """Deletes variant files of older snapshots (open file handles keep serving them)."""
+        for name in os.listdir(self.directory):
+            if name.startswith("playlist-") and name not in keep:
+                try:
+                    os.unlink(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+
+    def load(self):
+        """Restores the snapshot persisted by a previous process, if there is a valid one."""
+        if not self.directory:
+            return False
+        try:
+            with open(os.path.join(self.directory, "snapshot.json"), "rb") as f:
+                metadata = json.loads(f.read())
+            if metadata.get("format") != SNAPSHOT_FORMAT:
+                print(f"Ignoring playlist snapshot in {self.directory} in an unknown format.")
+                return False
+            files = {encoding: os.path.join(self.directory, name) for encoding, name in metadata["files"].items()}
+            variants = {}
+            for encoding, path in files.items():
+                with open(path, "rb") as f:
+                    variants[encoding] = f.read()
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Ignoring unreadable playlist snapshot in {self.directory}: {e}")
+            return False
+
+        body = variants.get("identity", b'')
+        if any(encoding not in variants for encoding in SUPPORTED_ENCODINGS):
+            # Saved without an encoding this process supports; rebuild them all
+            variants = None
+        snapshot = Snapshot(body, metadata["modified_at"], metadata.get("upstream_etag"),
+                            metadata.get("upstream_last_modified"), metadata.get("source_hash"),
+                            metadata.get("tvg_url"), variants)
+        if snapshot.etag != metadata.get("etag"):
+            print(f"Ignoring corrupt playlist snapshot in {self.directory}.")
+            return False
+        snapshot.files = files
+        with self.lock:
+            self.snapshot = snapshot
+            # Keep the real age so a stale snapshot is refreshed on the first request
+            self.updated_at = metadata["saved_at"]
+        print(f"Loaded playlist snapshot from {self.directory} ({len(body)} bytes, "
+              f"{int(time.time() - metadata['saved_at'])}s old).")
+        return True
+
+    def touch(self):
+        """Marks the cached body as fresh again without rebuilding it."""
+        with self.lock:
+            self.updated_at = time.time()
+
+    def is_reusable(self, snapshot):
+        """Whether an unchanged upstream lets `snapshot` be kept, i.e. its header points at the right guide."""
+        guide_url = self.epg_url if snapshot.tvg_url and self.epg_url else snapshot.tvg_url
+        if not guide_url:
+            return True
+        return snapshot.body.startswith(f'#EXTM3U url-tvg="{guide_url}"\n'.encode('utf-8'))
+
+    def conditional_headers(self):
+        """If-None-Match / If-Modified-Since for the upstream, once there is something to reuse."""
+        headers = {}
+        snapshot = self.snapshot
+        if snapshot is not None and self.is_reusable(snapshot):
+            if snapshot.upstream_etag:
+                headers["If-None-Match"] = snapshot.upstream_etag
+            if snapshot.upstream_last_modified:
+                headers["If-Modified-Since"] = snapshot.upstream_last_modified
+        return headers
+
+    def begin_refresh(self):
+        """Returns the in-flight fetch, starting one if none is running."""
+        with self.lock:
+            if self.flight is None:
+                self.flight = Flight()
+                threading.Thread(target=self._produce, args=(self.flight,), daemon=True).start()
+            return self.flight
+
+    def _produce(self, flight):
+        """Runs one fetch to completion, independent of the clients attached to it."""
+        error = None
+        stats = PipelineStats()
+        refresh_started = time.perf_counter()
+        spool = None
+        try:
+            r, lines_to_process, tvg_url, last_error = fetch_source_m3u(self.conditional_headers())
+            if r is not None and r.status_code == 304:
+                # Read the (empty) body so close() hands the connection back to the pool
+                r.content
+                r.close()
+                self.touch()
+                print("Refresh skipped, cached playlist is still current.")
+                return
+            if lines_to_process is None:
+                error = f"Could not retrieve a valid M3U. {last_error}"
+                print(f"Refresh failed, serving last good playlist. {error}")
+                return
+
+            etag = r.headers.get("ETag")
+            last_modified = r.headers.get("Last-Modified")
+            digest = hashlib.sha256()
+            spool = Spool(lines_to_process)
+
+            if self.snapshot is not None and not (etag or last_modified):
+                # No validators from upstream: hash the download first so an
+                # unchanged playlist is not categorized again
+                for raw_line in spool.lines():
+                    digest.update(raw_line + b'\n')
+                if digest.hexdigest() == self.snapshot.source_hash and self.is_reusable(self.snapshot):
+                    self.touch()
+                    print("Refresh skipped, upstream content hash is unchanged.")
+                    return
+                lines_to_process = spool.lines()
             else:
-                current_ext = None 
-                continue
+                lines_to_process = hash_lines(spool.lines(), digest)
+
+            # Pass the extracted EPG URL to the generator
+            upstream_waits = [0.0]
+            categorize_started = time.perf_counter()
+            header_tvg_url = self.epg_url if tvg_url and self.epg_url else tvg_url
+            for chunk in stream_and_categorize(timed_lines(lines_to_process, upstream_waits), header_tvg_url, self.entry_cache, stats):
+                flight.publish(chunk)
+            finished = time.perf_counter()
+            UPSTREAM_DOWNLOAD_SECONDS.observe(spool.finished_at - refresh_started)
+            CATEGORIZE_SECONDS.observe(finished - categorize_started - upstream_waits[0])
+            self.store(flight.collect(), etag, last_modified, digest.hexdigest(), tvg_url)
+            decisions = decide_category.cache_info()
+            print(f"Refresh complete ({self.entry_cache.hits} entries reused, {self.entry_cache.misses} categorized; "
+                  f"category cache {decisions.hits} hits / {decisions.misses} misses).")
+        except requests.exceptions.RequestException as e:
+            error = f"Upstream failed mid-stream: {e}"
+            print(f"Refresh failed, serving last good playlist. {error}")
+        except Exception as e:
+            # Anything else still has to reach the attached clients as a failure
+            error = f"Refresh failed unexpectedly: {e!r}"
+            print(f"Refresh failed, serving last good playlist. {error}")
+            traceback.print_exc()
+        finally:
+            if spool is not None:
+                spool.close()
+            record_pipeline_stats(stats)
+            with self.lock:
+                self.flight = None
+            flight.finish(error)
+
+    def start(self):
+        """Starts the periodic refresh worker (once per process)."""
+        with self.lock:
+            if self.worker is not None:
+                return
+            self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.begin_refresh()
+
+playlist_cache = PlaylistCache(REFRESH_INTERVAL, SNAPSHOT_DIR)
+playlist_cache.load()
+
+# ======== EPG Proxy (Filtered XMLTV) ========
+
+# Serve a guide cut down to our channels from /epg instead of the provider's full one
+EPG_PROXY = os.environ.get("EPG_PROXY", "1") == "1"
+# Absolute public URL of /epg for the playlist header. It is never derived from a
+# request's Host header (that would end up in the shared, persisted playlist);
+# while it is unset the provider's guide URL is passed through.
+EPG_PUBLIC_URL = os.environ.get("EPG_PUBLIC_URL")
+EPG_REFRESH_INTERVAL = int(os.environ.get("EPG_REFRESH_INTERVAL", 21600))
+EPG_MAX_AGE = int(os.environ.get("EPG_MAX_AGE", 3600))
+
+def emitted_tvg_ids(body):
+    """The tvg-ids of the entries in a categorized playlist body."""
+    return {tvg_id.decode('utf-8', 'replace') for tvg_id in TVG_ID_BYTES_REGEX.findall(body)}
+
+def guide_chunks(response):
+    """The decoded bytes of an XMLTV download, unpacking guides published as .xml.gz files."""
+    decompressor = None
+    for chunk in response.iter_content(chunk_size=UPSTREAM_CHUNK_SIZE):
+        if decompressor is None:
+            decompressor = zlib.decompressobj(31) if chunk.startswith(b'\x1f\x8b') else False
+        yield decompressor.decompress(chunk) if decompressor else chunk
+    if decompressor:
+        yield decompressor.flush()
 
-            # --- 2. De-Duplication Check ---
-            if line in seen_streams:
-                current_ext = None 
+def filter_guide(chunks, channel_ids, compressor):
+    """
+    Streams an XMLTV document through a pull parser and compresses only the
+    <channel> and <programme> elements of `channel_ids`. Each element is dropped
+    from the tree once handled, so memory stays flat however large the guide is.
+    Returns (gzip chunks, kept channels, kept programmes, seen elements).
+    """
+    parser = ET.XMLPullParser(events=("start", "end"))
+    output = []
+    root = None
+    depth = 0
+    kept_channels = kept_programmes = seen = 0
+    for chunk in chunks:
+        parser.feed(chunk)
+        for event, elem in parser.read_events():
+            if event == "start":
+                if root is None:
+                    root = elem
+                    attributes = ''.join(f' {name}={quoteattr(value)}' for name, value in elem.attrib.items())
+                    output.append(compressor.compress(f'<?xml version="1.0" encoding="UTF-8"?>\n<tv{attributes}>\n'.encode('utf-8')))
+                depth += 1
                 continue
-            seen_streams.add(line)
-
-            # --- 3. Keyword Categorization (Priority Check) ---
-            found = None
-            for cat_name in target_categories:
-                keywords = CATEGORIES.get(cat_name)
-                if keywords and any(kw in display_lower for kw in keywords):
-                    found = cat_name
-                    break
-            
-            # --- 4. Final Fallback Logic ---
-            final_group = found if found else fallback_category
+            depth -= 1
+            if depth != 1:
+                continue
+            seen += 1
+            if elem.tag == "channel":
+                keep = elem.get("id") in channel_ids
+                kept_channels += keep
+            elif elem.tag == "programme":
+                keep = elem.get("channel") in channel_ids
+                kept_programmes += keep
+            else:
+                keep = False
+            if keep:
+                elem.tail = "\n"
+                output.append(compressor.compress(ET.tostring(elem, encoding="utf-8", xml_declaration=False)))
+            root.clear()
+    parser.close()
+    output.append(compressor.compress(b'</tv>\n'))
+    output.append(compressor.flush())
+    return output, kept_channels, kept_programmes, seen
 
-            # --- 5. Final Formatting and Prefix Removal ---
-            
-            new_display_name = display_name
-            for prefix in ACCEPTABLE_PREFIXES:
-                if new_display_name.upper().startswith(prefix):
-                    new_display_name = new_display_name[len(prefix):].lstrip()
-                    break
+class EpgCache:
+    """
+    The provider's guide filtered down to the channels of the cached playlist,
+    kept gzip-compressed. It is rebuilt in the background once it is older than
+    EPG_REFRESH_INTERVAL or the playlist's set of tvg-ids has changed (a playlist
+    refresh that only changes URLs or ordering keeps the guide); builds are
+    serialized so concurrent requests share one download.
+    """
 
-            attributes = display_match.group(1).strip()
-            modified_ext_line = add_group_title(current_ext, final_group, new_display_name)
-            
-            yield modified_ext_line + '\n'
-            yield line + '\n'
+    def __init__(self, interval):
+        self.interval = interval
+        self.body = None
+        self.etag = None
+        self.updated_at = 0.0
+        self.channels_key = None
+        self.snapshot_etag = None
+        self.snapshot_channels = (None, None)
+        self.building = False
+        self.lock = threading.Lock()
+        self.build_lock = threading.Lock()
 
-            current_ext = None
+    def channels_of(self, snapshot):
+        """Returns (tvg-ids, key) for `snapshot`, remembering the last snapshot so requests don't rescan it."""
+        with self.lock:
+            if self.snapshot_etag == snapshot.etag:
+                return self.snapshot_channels
+        channel_ids = emitted_tvg_ids(snapshot.body)
+        digest = hashlib.sha256(snapshot.tvg_url.encode('utf-8'))
+        for tvg_id in sorted(channel_ids):
+            digest.update(b'\0' + tvg_id.encode('utf-8'))
+        channels = (channel_ids, digest.hexdigest())
+        with self.lock:
+            self.snapshot_etag = snapshot.etag
+            self.snapshot_channels = channels
+        return channels
 
-        elif current_ext:
-            current_ext = None
+    def is_stale(self, snapshot):
+        return time.time() - self.updated_at >= self.interval or self.channels_key != self.channels_of(snapshot)[1]
+
+    def build(self, snapshot):
+        """Downloads and filters the guide for `snapshot`. Returns an error message or None."""
+        with self.build_lock:
+            if self.body is not None and not self.is_stale(snapshot):
+                return None
+            channel_ids, channels_key = self.channels_of(snapshot)
+            started = time.perf_counter()
+            try:
+                r = upstream_session.get(snapshot.tvg_url, timeout=UPSTREAM_TIMEOUT, stream=True)
+                r.raise_for_status()
+                with r:
+                    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+                    output, channels, programmes, seen = filter_guide(guide_chunks(r), channel_ids, compressor)
+            except (requests.exceptions.RequestException, ET.ParseError, zlib.error) as e:
+                error = f"EPG download from {snapshot.tvg_url} failed: {e}"
+                print(error)
+                return error
+            body = b''.join(output)
+            with self.lock:
+                self.body = body
+                self.etag = hashlib.sha256(body).hexdigest()[:32]
+                self.updated_at = time.time()
+                self.channels_key = channels_key
+            print(f"EPG rebuilt in {time.perf_counter() - started:.1f}s: kept {channels} channels and "
+                  f"{programmes} programmes of {seen} elements ({len(body)} bytes compressed).")
+            return None
+
+    def begin_refresh(self, snapshot):
+        """Rebuilds in the background unless a build is already running."""
+        with self.lock:
+            if self.building:
+                return
+            self.building = True
+        threading.Thread(target=self._refresh, args=(snapshot,), daemon=True).start()
+
+    def _refresh(self, snapshot):
+        try:
+            self.build(snapshot)
+        finally:
+            with self.lock:
+                self.building = False
+
+epg_cache = EpgCache(EPG_REFRESH_INTERVAL)
+if EPG_PROXY:
+    playlist_cache.epg_url = EPG_PUBLIC_URL
 
 # ======== Routes (The Web URLs) ========
 
+# How long clients and reverse proxies may reuse /m3u before revalidating
+M3U_MAX_AGE = int(os.environ.get("M3U_MAX_AGE", 300))
+
+class ClosingFile(io.FileIO):
+    """
+    A file that runs callbacks when it is closed. The server closes a passed-through
+    file wrapper itself, without going through the response's own close callbacks.
+    """
+
+    def __init__(self, path):
+        super().__init__(path, "rb")
+        self.on_close = []
+
+    def close(self):
+        if not self.closed:
+            for callback in self.on_close:
+                callback()
+        super().close()
+
+def snapshot_body(snapshot, encoding):
+    """
+    The variant as a WSGI file wrapper over its on-disk copy, so the server can
+    sendfile() it without the bytes passing through Python. Falls back to the
+    in-memory copy when the snapshot is not persisted or its file has been replaced.
+    Returns (body, length, file or None).
+    """
+    path = snapshot.files.get(encoding)
+    if path is not None:
+        try:
+            f = ClosingFile(path)
+        except OSError:
+            pass
+        else:
+            return wrap_file(request.environ, f), os.fstat(f.fileno()).st_size, f
+    data = snapshot.variants[encoding]
+    return [data], len(data), None
+
+def snapshot_response(snapshot):
+    """
+    Serves the pre-compressed variant of a cached snapshot the client accepts,
+    with validators and byte ranges, answering conditional requests with 304/206.
+    """
+    encoding = negotiate_encoding()
+    body, length, body_file = snapshot_body(snapshot, encoding)
+    # Only the file wrapper is handed to the server as is, so it can use sendfile()
+    response = Response(body, mimetype="application/x-mpegurl", direct_passthrough=body_file is not None)
+    response.content_length = length
+    response.vary.add("Accept-Encoding")
+    if encoding == "identity":
+        response.set_etag(snapshot.etag)
+    else:
+        response.content_encoding = encoding
+        response.set_etag(f"{snapshot.etag}-{encoding}")
+    response.last_modified = snapshot.modified_at
+    response.cache_control.public = True
+    response.cache_control.max_age = M3U_MAX_AGE
+    response = response.make_conditional(request, accept_ranges=True, complete_length=length)
+    if response.status_code == 206 and body_file is not None and "wsgi.file_wrapper" in request.environ:
+        # make_conditional wrapped the file in a _RangeWrapper, which the server
+        # can only iterate. Hand it the server's own file wrapper instead, positioned
+        # at the range start: sendfile() sends Content-Length bytes from the file offset
+        # (PEP 3333 servers never send more than Content-Length).
+        body_file.seek(response.content_range.start)
+        response.response = body
+    if response.status_code in (200, 206):
+        OUTPUT_BYTES.inc(response.content_length, encoding=encoding)
+    return track_active(response, body_file)
+
+def count_output(chunks, encoding):
+    for chunk in chunks:
+        OUTPUT_BYTES.inc(len(chunk), encoding=encoding)
+        yield chunk
+
+def track_active(response, body_file=None):
+    """
+    Counts the response in the active-streams gauge until the server closes it:
+    through the response's close callbacks or, for a passed-through file, the file's close.
+    """
+    ACTIVE_STREAMS.inc()
+    finished = []
+
+    def done():
+        if not finished:
+            finished.append(True)
+            ACTIVE_STREAMS.dec()
+
+    response.call_on_close(done)
+    if body_file is not None:
+        body_file.on_close.append(done)
+    return response
+
 @app.route("/")
 def home():
     """Simple status page."""
@@ -168,8 +1908,9 @@ def home():
 @app.route("/m3u")
 def get_m3u():
     """
-    Fetches the source M3U using a retry mechanism, extracts the EPG URL,
-    and streams the result to avoid memory issues.
+    Serves the cached categorized playlist, refreshing it in the background once
+    it is stale. With an empty cache every client attaches to one shared upstream
+    fetch and the result is streamed to avoid memory issues.
     """
     username = os.environ.get("USERNAME")
     password = os.environ.get("PASSWORD")
@@ -177,55 +1918,196 @@ def get_m3u():
     if not username or not password:
         return Response("ERROR: IPTV credentials (USERNAME or PASSWORD) not set.", mimetype="text/plain", status=500)
 
-    # Use the only known stable host (with built-in retry logic)
-    host = "http://line.premiumpowers.net"
-    
-    # --- CRITICAL CHANGE: output=hls for improved streaming stability ---
-    m3u_url_template = f"{host}/get.php?username={username}&password={password}&type=m3u_plus&output=hls"
+    playlist_cache.start()
 
-    successful_response = None
-    lines_to_process = None
-    tvg_url = None
-    last_error = "Initial attempt failed."
-    
-    # Robust Retry Loop (up to 5 attempts)
-    for attempt in range(5):
-        m3u_url = m3u_url_template
-        print(f"Attempting connection to: {host} (Attempt {attempt + 1}/5)")
-        
-        try:
-            r = requests.get(m3u_url, timeout=300, stream=True) 
-            r.raise_for_status() 
-            
-            raw_lines_iterator = r.iter_lines()
-            first_line_raw = next(raw_lines_iterator, b'')
-            first_line = first_line_raw.decode('utf-8').strip()
-            
-            if first_line.startswith('#EXTM3U'):
-                successful_response = r
-                
-                tvg_match = TVG_URL_REGEX.search(first_line)
-                if tvg_match:
-                    tvg_url = tvg_match.group(1)
+    snapshot = playlist_cache.snapshot
+    if snapshot is not None:
+        if playlist_cache.is_stale():
+            playlist_cache.begin_refresh()
+        return snapshot_response(snapshot)
 
-                lines_to_process = itertools.chain([first_line_raw], raw_lines_iterator)
-                break 
-            else:
-                last_error = f"Host {host} returned content that didn't start with #EXTM3U."
-                print(last_error)
+    # Cold cache: attach to the shared fetch and stream it as it is produced
+    flight = playlist_cache.begin_refresh()
+    last_error = flight.wait_started()
 
-        except requests.exceptions.RequestException as e:
-            last_error = f"Host {host} failed with error: {e}"
-            print(last_error)
-        
-        time.sleep(5) 
+    if last_error is None:
+        # No cached variants yet: compress on the fly for clients that ask for it
+        encoding = negotiate_encoding()
+        response = Response(count_output(compress_stream(flight.stream(), encoding), encoding), mimetype="application/x-mpegurl")
+        response.vary.add("Accept-Encoding")
+        if encoding != "identity":
+            response.content_encoding = encoding
+        return track_active(response)
+    else:
+        return Response(f"Error: {last_error}", mimetype="text/plain", status=503)
+
+@app.route("/epg")
+def get_epg():
+    """
+    Serves the provider's XMLTV guide filtered to the channels in the playlist,
+    gzip-compressed. A stale guide is served while a new one is built.
+    """
+    snapshot = playlist_cache.snapshot
+    if not EPG_PROXY:
+        abort(404)
+    if snapshot is None:
+        return Response("ERROR: The playlist has not been loaded yet; request /m3u first.", mimetype="text/plain", status=503)
+    if not snapshot.tvg_url:
+        return Response("ERROR: The provider does not publish an EPG URL.", mimetype="text/plain", status=404)
+
+    if epg_cache.body is None:
+        error = epg_cache.build(snapshot)
+        if error is not None:
+            return Response(f"Error: {error}", mimetype="text/plain", status=503)
+    elif epg_cache.is_stale(snapshot):
+        epg_cache.begin_refresh(snapshot)
 
-    if successful_response:
-        # Pass the extracted EPG URL to the generator
-        return Response(stream_and_categorize(lines_to_process, tvg_url), mimetype="application/x-mpegurl")
+    body, etag = epg_cache.body, epg_cache.etag
+    if request.accept_encodings.best_match(("gzip", "identity"), default="identity") == "gzip":
+        response = Response(body, mimetype="application/xml")
+        response.content_encoding = "gzip"
+        response.set_etag(f"{etag}-gzip")
     else:
-        print("FATAL: All attempts failed to return a valid M3U file.")
-        return Response(f"Error: Could not retrieve a valid M3U after 5 retries. Last error was: {last_error}", mimetype="text/plain", status=503)
+        response = Response(gzip.decompress(body), mimetype="application/xml")
+        response.set_etag(etag)
+    response.vary.add("Accept-Encoding")
+    response.cache_control.public = True
+    response.cache_control.max_age = EPG_MAX_AGE
+    return response.make_conditional(request)
+
+@app.route("/metrics")
+def metrics():
+    """Prometheus text exposition of the fetch, categorization and serving metrics."""
+    decisions = decide_category.cache_info()
+    CATEGORY_CACHE_LOOKUPS.set(decisions.hits, result="hit")
+    CATEGORY_CACHE_LOOKUPS.set(decisions.misses, result="miss")
+    snapshot = playlist_cache.snapshot
+    if snapshot is not None:
+        PLAYLIST_BYTES.set(len(snapshot.body))
+        PLAYLIST_AGE_SECONDS.set(round(time.time() - playlist_cache.updated_at, 3))
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+@app.route("/upstream")
+def upstream_status():
+    """Circuit breaker state, counters and latency average of every upstream host."""
+    hosts = []
+    for host in UPSTREAM_HOSTS:
+        status = circuit_breakers[host].status()
+        latency = host_latency.averages.get(host)
+        status["latency_seconds"] = None if latency is None else round(latency, 3)
+        hosts.append(status)
+    return Response(json.dumps({"hosts": hosts}, indent=2), mimetype="application/json")
+
+# ======== On-Demand Profiling ========
+
+# /debug/profile is disabled unless a token is configured
+PROFILE_TOKEN = os.environ.get("PROFILE_TOKEN")
+PROFILE_SAMPLE_INTERVAL = float(os.environ.get("PROFILE_SAMPLE_INTERVAL", 0.005))
+
+# The SIGPROF handler and ITIMER_PROF are process-wide, so one profile runs at a time
+profile_lock = threading.Lock()
+
+class StackSampler:
+    """
+    Low-overhead SIGPROF sampler: every PROFILE_SAMPLE_INTERVAL seconds of CPU
+    time it records the running Python stack, for collapsed-stack flame graphs.
+    Signals are delivered to the main thread, which is where the gevent workers
+    run every request; elsewhere signal.signal() raises ValueError.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.stacks = Counter()
+        self.previous_handler = None
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        self.stacks[';'.join(reversed(stack))] += 1
+
+    def __enter__(self):
+        self.previous_handler = signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        return self
+
+    def __exit__(self, *exc_info):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self.previous_handler)
+
+    def collapsed(self):
+        return ''.join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+def run_profiled_categorization():
+    """Fetches the playlist and categorizes it once, discarding the output. Returns (stats, bytes, error)."""
+    r, lines_to_process, tvg_url, last_error = fetch_source_m3u()
+    if lines_to_process is None:
+        return None, 0, last_error
+    stats = PipelineStats()
+    output_bytes = 0
+    try:
+        for piece in stream_and_categorize(lines_to_process, tvg_url, stats=stats):
+            output_bytes += len(piece)
+    except requests.exceptions.RequestException as e:
+        return None, output_bytes, f"Upstream failed mid-stream: {e}"
+    return stats, output_bytes, None
+
+@app.route("/debug/profile")
+def debug_profile():
+    """
+    Runs one fetch + categorization under a profiler and returns the result.
+    ?mode=cprofile (default) gives the top functions (?sort=cumulative|tottime, ?limit=N);
+    ?mode=collapsed gives sampled collapsed stacks for flamegraph.pl or speedscope.
+    Requires PROFILE_TOKEN in an "Authorization: Bearer" header; it is not accepted
+    in the query string, which ends up in router and access logs. Only one profile
+    runs at a time; requests made meanwhile get a 409.
+    """
+    if not PROFILE_TOKEN:
+        abort(404)
+    authorization = request.headers.get("Authorization", "")
+    supplied = authorization[len("Bearer "):] if authorization.startswith("Bearer ") else ""
+    if not hmac.compare_digest(supplied.encode('utf-8'), PROFILE_TOKEN.encode('utf-8')):
+        return Response("ERROR: invalid or missing profiling token.", mimetype="text/plain", status=401)
+
+    mode = request.args.get("mode", "cprofile")
+    if mode not in ("cprofile", "collapsed"):
+        return Response("ERROR: mode must be cprofile or collapsed.", mimetype="text/plain", status=400)
+    if not profile_lock.acquire(blocking=False):
+        return Response("ERROR: a profile is already running; try again when it finishes.", mimetype="text/plain", status=409)
+    try:
+        started = time.perf_counter()
+        if mode == "collapsed":
+            try:
+                with StackSampler(PROFILE_SAMPLE_INTERVAL) as sampler:
+                    stats, output_bytes, error = run_profiled_categorization()
+            except ValueError as e:
+                return Response(f"ERROR: sampling profiler unavailable here ({e}); use mode=cprofile.", mimetype="text/plain", status=400)
+            report = sampler.collapsed()
+        else:
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                stats, output_bytes, error = run_profiled_categorization()
+            finally:
+                profiler.disable()
+            buffer = io.StringIO()
+            sort = request.args.get("sort", "cumulative")
+            if sort not in ("cumulative", "tottime", "ncalls"):
+                sort = "cumulative"
+            pstats.Stats(profiler, stream=buffer).sort_stats(sort).print_stats(request.args.get("limit", 40, type=int))
+            report = buffer.getvalue()
+    finally:
+        profile_lock.release()
+
+    if error is not None:
+        return Response(f"Error: {error}", mimetype="text/plain", status=503)
+
+    elapsed = time.perf_counter() - started
+    summary = (f"# {stats.processed} entries processed, {sum(stats.emitted.values())} emitted, "
+               f"{output_bytes} bytes in {elapsed:.2f}s ({mode})\n")
+    return Response(summary + report, mimetype="text/plain")
 
 # ======== Run App (unchanged) ========
 if __name__ == "__main__":
@@ -0,0 +1,368 @@
+"""
+Synthetic playlist generator and microbenchmarks for the categorization hot path.
+
+Run with:
+    python benchmark.py                                  # 10k and 100k entries
+    python benchmark.py --sizes 10k,100k,1m --save baseline.json
+    python benchmark.py --compare baseline.json          # flag regressions against a saved run
+"""
+import argparse
+import gc
+import json
+import platform
+import random
+import resource
+import sys
+import time
+import tracemalloc
+
+import app
+
+# ======== Synthetic Playlist Generator ========
+
+# Display names seen in real provider playlists, per region prefix
+REGION_NAMES = {
+    "US": [
+        "CNN HD", "FOX Sports 1", "HBO Signature", "Nick Jr", "ESPN 2 FHD", "Telemundo Chicago",
+        "Discovery Science", "WGN America", "A&E East", "Cartoon Network", "Local 5 Backup",
+        "Random Channel XYZ", "MSNBC", "Starz Encore", "Univision Este", "NFL Network", "HGTV",
+    ],
+    "MX": [
+        "Las Estrellas", "Canal 5 HD", "Milenio Noticias", "Discovery Kids", "Azteca Uno",
+        "Fútbol Total", "Imagen TV", "Cinema Dinamita", "Canal Once", "Niños Clásicos",
+    ],
+    "OTHER": [
+        "UK| BBC One", "UK| Sky Sports Main Event", "CA| CBC Toronto", "AR| TyC Sports",
+        "ES| La 1", "FR| TF1", "DE| Das Erste", "IN| Star Plus",
+    ],
+}
+MX_PREFIXES = ("MX|", "MXC|")
+
+
+def parse_size(text):
+    """'10k' -> 10000, '1m' -> 1000000."""
+    text = text.strip().lower()
+    multiplier = {"k": 1000, "m": 1000000}.get(text[-1:], 1)
+    return int(float(text.rstrip("km")) * multiplier)
+
+
+def generate_playlist(count, us_ratio=0.45, mx_ratio=0.25, duplicate_ratio=0.1,
+                      attributes="rich", noise_ratio=0.001, seed=1):
+    """
+    Builds raw m3u_plus lines the way `r.iter_lines()` hands them to the parser.
+
+    Entries are split between US, Mexican and other regions, `duplicate_ratio` of
+    them reuse an earlier stream URL (backup feeds), and `noise_ratio` of them are
+    preceded by a line that is not valid UTF-8.
+    """
+    rng = random.Random(seed)
+    lines = [b'#EXTM3U url-tvg="http://epg.example/guide.xml" x-tvg-url="http://epg.example/guide.xml"']
+    urls = []
+    for i in range(count):
+        roll = rng.random()
+        if roll < us_ratio:
+            name = f"US| {rng.choice(REGION_NAMES['US'])}"
+        elif roll < us_ratio + mx_ratio:
+            name = f"{rng.choice(MX_PREFIXES)} {rng.choice(REGION_NAMES['MX'])}"
+        else:
+            name = rng.choice(REGION_NAMES["OTHER"])
+        name = f"{name} {i % 97}"
+
+        if attributes == "rich":
+            attrs = (f'tvg-id="ch{i}.tv" tvg-name="{name}" tvg-logo="http://logo.example/{i}.png" '
+                     f'tvg-chno="{i}" tvg-shift="0" catchup="default" catchup-days="7" group-title="Group {i % 40}"')
+        else:
+            attrs = f'tvg-id="ch{i}.tv"'
+
+        if urls and rng.random() < duplicate_ratio:
+            url = rng.choice(urls)
+        else:
+            url = f'http://stream.example/live/user/pass/{i}.ts'
+            urls.append(url)
+
+        if rng.random() < noise_ratio:
+            lines.append(b'#EXTVLCOPT:\xff\xfe broken \xc3')
+        lines.append(f'#EXTINF:-1 {attrs},{name}'.encode('utf-8'))
+        lines.append(url.encode('utf-8'))
+    return lines
+
+
+# ======== Reference Checks ========
+
+def legacy_match(display_lower, target_categories):
+    """The original per-category `any()` keyword scan, kept as the reference."""
+    for cat_name in target_categories:
+        keywords = app.CATEGORIES.get(cat_name)
+        if keywords and any(kw in display_lower for kw in keywords):
+            return cat_name
+    return None
+
+
+def display_names(lines):
+    """(region, lower-cased display name) for every US/MX entry in `lines`."""
+    names = []
+    for line in lines:
+        match = app.EXTINF_BYTES_REGEX.match(line)
+        if not match:
+            continue
+        try:
+            display_lower = match.group(2).decode('utf-8').strip().lower()
+        except UnicodeDecodeError:
+            continue
+        if display_lower.startswith('us|'):
+            names.append(("US", display_lower))
+        elif display_lower.startswith(('mx|', 'mxc|')):
+            names.append(("MX", display_lower))
+    return names
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+
+def check_keyword_matcher(lines):
+    names = display_names(lines)
+    expected, legacy_time = timed(lambda: [legacy_match(name, app.REGION_CATEGORIES[region][0]) for region, name in names])
+    actual, matcher_time = timed(lambda: [app.CATEGORY_MATCHERS[region].match(name) for region, name in names])
+    mismatches = sum(1 for a, b in zip(expected, actual) if a != b)
+    print(f"  keyword matcher   : {legacy_time / matcher_time:6.2f}x faster than the any() scan, {mismatches} mismatches")
+    return mismatches
+
+
+def check_rewriter(lines):
+    extinf_lines = [line for line in lines if line.startswith(b'#EXTINF')]
+    expected, legacy_time = timed(lambda: [app.add_group_title(line.decode('utf-8'), "USA News", "CNN HD").encode('utf-8') for line in extinf_lines])
+    actual, rewrite_time = timed(lambda: [app.rewrite_extinf(line, "USA News", "CNN HD") for line in extinf_lines])
+    mismatches = sum(1 for a, b in zip(expected, actual) if a != b)
+    print(f"  EXTINF rewriter   : {legacy_time / rewrite_time:6.2f}x faster than add_group_title, {mismatches} mismatches")
+    return mismatches
+
+
+def check_dedup(count):
+    """Memory held per request by each de-duplication structure after `count` unique streams."""
+    structures = [
+        ("python set of URLs", set),
+        ("StreamHashSet", app.StreamHashSet),
+        ("StreamBloomFilter", lambda: app.StreamBloomFilter(app.DEDUP_BLOOM_CAPACITY, app.DEDUP_BLOOM_FALSE_POSITIVE_RATE)),
+    ]
+    for label, factory in structures:
+        # Fresh URL objects, so the set is charged for the strings it keeps alive
+        tracemalloc.start()
+        seen = factory()
+        for i in range(count):
+            seen.add(f'http://stream.example/live/user/pass/{i}.ts'.encode('utf-8'))
+        held, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del seen
+        print(f"  {label:<18}: {held / 1e6:6.2f} MB held per request for {count} streams")
+
+
+# ======== Stages ========
+
+def stage_categorize(lines):
+    names = display_names(lines)
+
+    def run():
+        app.decide_category.cache_clear()
+        for region, name in names:
+            app.decide_category(region, name)
+    return len(names), sum(len(name) for _, name in names), run
+
+
+def stage_rewrite(lines):
+    extinf_lines = [line for line in lines if line.startswith(b'#EXTINF')]
+
+    def run():
+        for line in extinf_lines:
+            app.rewrite_extinf(line, "USA News", "CNN HD")
+    return len(extinf_lines), sum(len(line) for line in extinf_lines), run
+
+
+def stage_dedup(lines):
+    urls = [line for line in lines if line.startswith(app.STREAM_PREFIXES)]
+
+    def run():
+        seen = app.new_seen_streams()
+        for url in urls:
+            seen.add(url)
+    return len(urls), sum(len(url) for url in urls), run
+
+
+def stage_pipeline(lines):
+    entries = sum(1 for line in lines if line.startswith(b'#EXTINF'))
+
+    def run():
+        app.decide_category.cache_clear()
+        flight = app.Flight()
+        for piece in app.stream_and_categorize(iter(lines)):
+            flight.publish(piece)
+        flight.collect()
+    return entries, sum(len(line) + 1 for line in lines), run
+
+
+def stage_incremental(lines):
+    """Second refresh of an unchanged playlist with a warm EntryCache."""
+    entries = sum(1 for line in lines if line.startswith(b'#EXTINF'))
+    entry_cache = app.EntryCache()
+    for _ in app.stream_and_categorize(iter(lines), entry_cache=entry_cache):
+        pass
+
+    def run():
+        for _ in app.stream_and_categorize(iter(lines), entry_cache=entry_cache):
+            pass
+    return entries, sum(len(line) + 1 for line in lines), run
+
+
+def stage_compress(lines):
+    body = b''.join(app.stream_and_categorize(iter(lines)))
+    entries = body.count(b'\n#EXTINF')
+
+    def run():
+        app.compress_variants(body)
+    return entries, len(body), run
+
+
+STAGES = [
+    ("categorize", stage_categorize),
+    ("rewrite", stage_rewrite),
+    ("dedup", stage_dedup),
+    ("pipeline", stage_pipeline),
+    ("incremental", stage_incremental),
+    ("compress", stage_compress),
+]
+
+
+def read_rss_kb():
+    """Current and peak resident set size (VmRSS, VmHWM) in KB, or None off Linux."""
+    try:
+        with open("/proc/self/status") as f:
+            fields = dict(line.split(":", 1) for line in f)
+        return int(fields["VmRSS"].split()[0]), int(fields["VmHWM"].split()[0])
+    except (OSError, KeyError, ValueError):
+        return None
+
+def reset_peak_rss():
+    """Lowers the kernel's peak-RSS mark to the current RSS (Linux); False where unsupported."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+def measure(stage):
+    """
+    Runs a stage once for timing and once under tracemalloc for allocations.
+    RSS growth is how far the peak RSS rose above the RSS at the start of the
+    timed run. Without a resettable peak (non-Linux) it falls back to the growth
+    of ru_maxrss, which only shows growth beyond the earlier stages' peak.
+    """
+    entries, size, run = stage
+    gc.collect()
+    if reset_peak_rss() and read_rss_kb() is not None:
+        start_rss, _ = read_rss_kb()
+        _, elapsed = timed(run)
+        rss_growth = read_rss_kb()[1] - start_rss
+    else:
+        start_maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        _, elapsed = timed(run)
+        rss_growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start_maxrss
+
+    tracemalloc.start()
+    run()
+    _, alloc_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "entries_per_sec": entries / elapsed,
+        "bytes_per_sec": size / elapsed,
+        "alloc_peak_bytes": alloc_peak,
+        "rss_growth_kb": rss_growth,
+    }
+
+
+# ======== Baselines ========
+
+def compare(results, config, baseline, tolerance):
+    """Prints throughput and allocation changes against a saved run; returns the number of regressions."""
+    regressions = 0
+    print(f"\nComparison with baseline from {baseline.get('created', 'unknown date')}")
+    if baseline.get("config", {}) != config:
+        print("  note: the baseline was generated with different playlist settings")
+    for size, stages in results.items():
+        for name, current in stages.items():
+            previous = baseline.get("results", {}).get(size, {}).get(name)
+            if previous is None:
+                continue
+            speed = current["entries_per_sec"] / previous["entries_per_sec"] - 1
+            memory = current["alloc_peak_bytes"] / max(previous["alloc_peak_bytes"], 1) - 1
+            flag = ""
+            if speed < -tolerance or memory > tolerance:
+                flag = "  <-- REGRESSION"
+                regressions += 1
+            print(f"  {size:>8} {name:<12} throughput {speed:+7.1%}   allocations {memory:+7.1%}{flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="10k,100k", help="comma-separated entry counts, e.g. 10k,100k,1m")
+    parser.add_argument("--us-ratio", type=float, default=0.45, help="share of US| entries")
+    parser.add_argument("--mx-ratio", type=float, default=0.25, help="share of MX|/MXC| entries; the rest is filtered out")
+    parser.add_argument("--duplicates", type=float, default=0.1, help="share of entries reusing an earlier stream URL")
+    parser.add_argument("--attributes", choices=("rich", "minimal"), default="rich", help="EXTINF attribute richness")
+    parser.add_argument("--noise", type=float, default=0.001, help="share of entries preceded by a non-UTF-8 line")
+    parser.add_argument("--stages", default=",".join(name for name, _ in STAGES), help="comma-separated stages to run")
+    parser.add_argument("--save", metavar="FILE", help="write the results as a baseline")
+    parser.add_argument("--compare", metavar="FILE", help="compare against a saved baseline")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed slowdown before a stage is flagged")
+    args = parser.parse_args(argv)
+
+    sizes = [parse_size(size) for size in args.sizes.split(",")]
+    selected = set(args.stages.split(","))
+    config = {key: value for key, value in vars(args).items() if key not in ("save", "compare", "tolerance")}
+
+    results = {}
+    mismatches = 0
+    for count in sizes:
+        lines = generate_playlist(count, args.us_ratio, args.mx_ratio, args.duplicates, args.attributes, args.noise)
+        input_mb = sum(len(line) + 1 for line in lines) / 1e6
+        print(f"\n{count} entries ({input_mb:.1f} MB)")
+
+        if count == sizes[0]:
+            mismatches += check_keyword_matcher(lines)
+            mismatches += check_rewriter(lines)
+            check_dedup(count)
+
+        results[str(count)] = {}
+        for name, build in STAGES:
+            if name not in selected:
+                continue
+            stats = measure(build(lines))
+            results[str(count)][name] = stats
+            print(f"  {name:<12} {stats['entries_per_sec']:12,.0f} entries/s {stats['bytes_per_sec'] / 1e6:8.1f} MB/s"
+                  f"   alloc peak {stats['alloc_peak_bytes'] / 1e6:8.2f} MB   RSS growth {stats['rss_growth_kb'] / 1024:7.1f} MB")
+        del lines
+
+    regressions = 0
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, config, json.load(f), args.tolerance)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({
+                "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "python": platform.python_version(),
+                "config": config,
+                "results": results,
+            }, f, indent=2)
+        print(f"\nBaseline saved to {args.save}")
+
+    return 1 if mismatches or regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())